@@ -1,6 +1,7 @@
 import datetime
-import json
+import heapq
 
+import orjson
 import requests
 from flask import render_template, redirect, request
 
@@ -10,20 +11,44 @@ from app import app
 # se comunicará para obtener y enviar información
 CONNECTED_NODE_ADDRESS = "http://127.0.0.1:8000"
 
-posts = []
+# Número de bloques, los más recientes, que se muestran en la página.
+POSTS_PER_PAGE = 50
+
+# Montículo con los bloques recibidos como (timestamp negado, índice,
+# bloque), de modo que los más recientes son los menores.
+posts_heap = []
+# Índice y hash del último bloque recibido del nodo.
+last_index = -1
+last_hash = None
 
 
 def fetch_posts():
     """
     Función para obtener la cadena desde un nodo blockchain,
     procesar la información y almacenarla localmente.
+    Solo se piden al nodo los bloques posteriores al último recibido,
+    junto con este para comprobar que la cadena no ha cambiado.
     """
+    global last_index, last_hash
     get_chain_address = "{}/chain".format(CONNECTED_NODE_ADDRESS)
-    response = requests.get(get_chain_address)
+    since = last_index - 1 if last_index >= 0 else -1
+    response = requests.get(get_chain_address, params={'since': since})
     if response.status_code == 200:
-        content = []        
-        chain = json.loads(response.content)  
-        for block in chain["chain"]:
+        chain = orjson.loads(response.content)
+        blocks = chain["chain"]
+        if last_index >= 0:
+            if not blocks or blocks[0]["hash"] != last_hash:
+                # El nodo ha reemplazado su cadena por otra (más corta o
+                # de otra rama): se descarta lo almacenado y se vuelve a
+                # pedir entera.
+                del posts_heap[:]
+                last_index = -1
+                last_hash = None
+                fetch_posts()
+                return
+            blocks = blocks[1:]
+
+        for block in blocks:
             bloque = {}
             bloque['index'] = block["index"]
             bloque['transactions'] = block["transactions"]
@@ -32,16 +57,18 @@ def fetch_posts():
             bloque['hash'] = block["hash"]
             if 'nonce' in block:
                 bloque['nonce'] = block["nonce"]
-            content.append(bloque)
 
-        global posts
-        posts = sorted(content, key=lambda k: k['timestamp'],
-                       reverse=True)
+            heapq.heappush(posts_heap,
+                           (-bloque['timestamp'], bloque['index'], bloque))
+            last_index = bloque['index']
+            last_hash = bloque['hash']
 
 
 @app.route('/')
 def index():
     fetch_posts()
+    posts = [post for _, _, post in
+             heapq.nsmallest(POSTS_PER_PAGE, posts_heap)]
     return render_template('index.html',
                            title='IES Fleming Net: Red descentralizada '
                                  'para compartir información',
@@ -2,14 +2,27 @@ import os
 import sys
 import signal
 import atexit
+import multiprocessing
 from hashlib import sha256
-import json
+import math
 import time
+from array import array
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from flask import Flask, request
-import requests
+from quart import Quart, Response, request
+import httpx
+import orjson
 
 class Block:
+    # Atributos fijos del bloque: sin `__dict__` por instancia.
+    __slots__ = ('index', 'transactions', 'timestamp', 'previous_hash',
+                 'nonce', 'hash', '_hash_cache')
+    # Campos que intervienen en el hash del bloque, en el orden en que se
+    # serializan. El nonce va siempre el último.
+    CANONICAL_FIELDS = ('index', 'previous_hash', 'timestamp', 'transactions',
+                        'nonce')
+
     def __init__(self, index, transactions, timestamp, previous_hash,nonce=0):
         """
         Constructor de la clase `Block`.
@@ -22,26 +35,142 @@ class Block:
         self.timestamp = timestamp
         self.previous_hash = previous_hash
         self.nonce = nonce
+        # Hash con el que se añadió el bloque a la cadena.
+        self.hash = None
+        # Hash ya calculado del bloque; se descarta al modificar el nonce.
+        self._hash_cache = None
+
+    @classmethod
+    def from_dict(cls, block_data):
+        """
+        Construye un bloque, con su hash, a partir de un diccionario como
+        los que retorna `to_dict`.
+        """
+        block = cls(block_data["index"],
+                    block_data["transactions"],
+                    block_data["timestamp"],
+                    block_data["previous_hash"],
+                    block_data["nonce"])
+        block.hash = block_data["hash"]
+        return block
+
+    def to_dict(self):
+        """
+        Retorna los campos públicos del bloque, listos para serializar.
+        """
+        return {field: getattr(self, field)
+                for field in (*Block.CANONICAL_FIELDS, 'hash')}
+
+    def has_valid_fields(self):
+        """
+        Comprueba que los campos tienen los tipos con los que se guardan en
+        la cadena, para que lo almacenado (y lo que se envía a otros nodos)
+        sea exactamente lo que se ha hasheado.
+        """
+        return (type(self.index) is int and 0 <= self.index < 2 ** 64 and
+                type(self.timestamp) is float and
+                math.isfinite(self.timestamp) and
+                type(self.nonce) is int and 0 <= self.nonce < 2 ** 64 and
+                isinstance(self.previous_hash, str) and
+                isinstance(self.transactions, list))
+
+    def hash_prefix(self):
+        """
+        Convierte los campos del bloque, salvo el nonce, en una lista JSON
+        que termina justo donde empiezan los dígitos del nonce. Como es la
+        única parte que cambia durante la prueba de trabajo, el estado de
+        SHA-256 tras este prefijo puede calcularse una sola vez y
+        reutilizarse.
+        """
+        # Los campos se serializan en el orden fijo de CANONICAL_FIELDS; las
+        # claves de las transacciones se ordenan para que el hash no dependa
+        # del orden en que las haya serializado cada nodo. El propio hash no
+        # forma parte de los campos, de modo que el resultado no depende de
+        # si el bloque ya ha sido minado o no.
+        fields = [getattr(self, field) for field in Block.CANONICAL_FIELDS[:-1]]
+        prefix = orjson.dumps(fields, option=orjson.OPT_SORT_KEYS)[:-1] + b','
+        # Se rellena con espacios (JSON sigue siendo válido) hasta que el
+        # prefijo ocupe un número exacto de bloques de 64 bytes de SHA-256.
+        # Así el estado intermedio no guarda bytes a medias y cada intento
+        # de nonce, junto con el relleno final de SHA-256, cabe en un único
+        # bloque de compresión.
+        padding = -(len(prefix) + 1) % 64
+        return prefix + b' ' * padding + b'"'
+
+    @staticmethod
+    def nonce_suffix(nonce):
+        """
+        Retorna la parte final de la lista JSON del bloque para un nonce dado.
+        """
+        # El nonce se escribe con un ancho fijo de 20 dígitos (como cadena
+        # para que el JSON siga siendo válido), de modo que el mensaje a
+        # hashear siempre tiene la misma longitud y se formatea directamente
+        # como bytes, sin pasar por str.
+        return b'%020d"]' % nonce
+
+    def canonical_bytes(self):
+        """
+        Retorna la serialización canónica del bloque sobre la que se
+        calcula su hash. No incluye el campo hash.
+        """
+        return self.hash_prefix() + self.nonce_suffix(self.nonce)
+
     def compute_hash(self):
         """
         Convierte el bloque en una cadena JSON y luego retorna el hash
-        del mismo.
+        del mismo. El resultado se guarda para no recalcularlo en las
+        sucesivas validaciones del bloque.
         """
-        # La cadena equivalente también considera el nuevo campo previous_hash,
-        # pues self.__dict__ devuelve todos los campos de la clase.
-        block_string = json.dumps(self.__dict__, sort_keys=True)
-        return sha256(block_string.encode()).hexdigest()
+        if self._hash_cache is None:
+            self._hash_cache = sha256(self.canonical_bytes()).hexdigest()
+        return self._hash_cache
+
+    def _invalidate(self):
+        """
+        Descarta el hash guardado tras modificar algún campo del bloque.
+        """
+        self._hash_cache = None
 
 class Blockchain:
     # Dificultad del algoritmo de prueba de trabajo.
     difficulty = 3
+    # Un hash con `difficulty` ceros hexadecimales al inicio equivale a un
+    # entero de 256 bits menor que este valor.
+    target = 1 << (256 - 4 * difficulty)
+    # Número de nonces que se prueban en cada lote de la búsqueda.
+    nonce_batch = 4096
+    # Número de procesos que minan en paralelo. Con la dificultad por
+    # defecto arrancar los procesos cuesta más que la propia búsqueda,
+    # así que solo se activa si se indica en la variable POW_WORKERS.
+    pow_workers = int(os.environ.get('POW_WORKERS', 1))
+    # El minado en paralelo necesita `fork` para que los procesos hereden el
+    # estado de SHA-256; no existe en Windows.
+    can_fork = 'fork' in multiprocessing.get_all_start_methods()
 
     def __init__(self, chain=None):
-        self.unconfirmed_transactions = []
-        self.chain = chain
-        if self.chain is None:
-            self.chain = []
+        # Transacciones pendientes indexadas por su hash, para que los
+        # bloques anunciados puedan reconstruirse a partir de los hashes.
+        self.unconfirmed_transactions = {}
+        # La cadena se guarda por columnas, una lista o array por campo,
+        # en lugar de como una lista de objetos `Block`: ocupa menos memoria
+        # y los recorridos de toda la cadena no saltan de objeto en objeto.
+        self.indices = array('Q')
+        self.timestamps = array('d')
+        self.previous_hashes = []
+        self.hashes = []
+        self.nonces = array('Q')
+        self.transactions = []
+        # Fichero de registro en el que se añade una línea por cada bloque
+        # nuevo, o None si el nodo no guarda la cadena en disco.
+        self.log = None
+        if chain is None:
             self.create_genesis_block()
+        else:
+            for block in chain:
+                self.append_block(block)
+
+    def __len__(self):
+        return len(self.hashes)
 
     def create_genesis_block(self):
         """
@@ -49,9 +178,60 @@ class Blockchain:
         cadena. El bloque tiene index 0, previous_hash 0 y un hash
         válido.
         """
-        genesis_block = Block(0, [], 0, "0")
+        genesis_block = Block(0, [], 0.0, "0")
         genesis_block.hash = genesis_block.compute_hash()
-        self.chain.append(genesis_block)
+        self.append_block(genesis_block)
+
+    def append_block(self, block):
+        """
+        Guarda los campos de un bloque ya verificado al final de la cadena.
+        Si alguno no puede guardarse, las columnas quedan como estaban.
+        """
+        length = len(self)
+        columns = (self.indices, self.timestamps, self.previous_hashes,
+                   self.hashes, self.nonces, self.transactions)
+        try:
+            self.indices.append(block.index)
+            self.timestamps.append(block.timestamp)
+            self.previous_hashes.append(block.previous_hash)
+            self.hashes.append(block.hash)
+            self.nonces.append(block.nonce)
+            self.transactions.append(block.transactions)
+        except (TypeError, OverflowError):
+            for column in columns:
+                del column[length:]
+            raise
+
+    def block(self, position):
+        """
+        Construye un objeto `Block` con los datos del bloque que ocupa
+        `position` en la cadena.
+        """
+        block = Block(self.indices[position],
+                      self.transactions[position],
+                      self.timestamps[position],
+                      self.previous_hashes[position],
+                      self.nonces[position])
+        block.hash = self.hashes[position]
+        # El bloque se verificó al añadirlo, así que su hash es conocido.
+        block._hash_cache = block.hash
+        return block
+
+    def iter_dicts(self, start=0, end=None):
+        """
+        Recorre los bloques de `start` a `end` como diccionarios listos
+        para serializar, sin construir objetos `Block` intermedios ni
+        copiar las columnas.
+        """
+        if end is None:
+            end = len(self)
+        for position in range(start, end):
+            yield {"index": self.indices[position],
+                   "transactions": self.transactions[position],
+                   "timestamp": self.timestamps[position],
+                   "previous_hash": self.previous_hashes[position],
+                   "nonce": self.nonces[position],
+                   "hash": self.hashes[position]}
 
     @property
     def last_block(self):
@@ -60,7 +240,71 @@ class Blockchain:
         Nótese que la cadena siempre contendrá al menos un último bloque (o sea,
         el bloque génesis).
         """
-        return self.chain[-1]
+        return self.block(-1)
+
+    @staticmethod
+    def search_nonce(midstate, start, count):
+        """
+        Prueba `count` nonces consecutivos a partir de `start` sobre el
+        estado de SHA-256 del prefijo del bloque. Retorna el primer nonce
+        que satisface la dificultad, o None si no hay ninguno en el lote.
+        """
+        # hashlib delega en OpenSSL, que ya usa las instrucciones SHA-NI
+        # cuando la CPU las soporta; lo que queda por ahorrar es el coste
+        # de Python dentro del bucle. Por eso se compara el digest binario
+        # como entero en lugar de pasarlo a hexadecimal en cada intento.
+        target = Blockchain.target
+        nonce_suffix = Block.nonce_suffix
+        for nonce in range(start, start + count):
+            attempt = midstate.copy()
+            attempt.update(nonce_suffix(nonce))
+            if int.from_bytes(attempt.digest(), 'big') < target:
+                return nonce
+        return None
+
+    @staticmethod
+    def search_worker(midstate, start, stride, found_event, result_queue):
+        """
+        Proceso de minado en paralelo: prueba los lotes de nonces que
+        empiezan en `start`, `start + stride`, ... hasta encontrar uno
+        válido o hasta que otro proceso avise de que ya lo ha encontrado.
+        """
+        while not found_event.is_set():
+            nonce = Blockchain.search_nonce(midstate, start,
+                                            Blockchain.nonce_batch)
+            if nonce is not None:
+                result_queue.put(nonce)
+                found_event.set()
+                return
+            start += stride
+
+    @staticmethod
+    def parallel_search(midstate, workers):
+        """
+        Reparte la búsqueda del nonce entre `workers` procesos, cada uno
+        con un subconjunto disjunto de lotes, y retorna el primer nonce
+        válido que encuentre cualquiera de ellos.
+        """
+        # Con `fork` los procesos heredan el estado de SHA-256 del prefijo
+        # sin necesidad de serializarlo.
+        context = multiprocessing.get_context('fork')
+        found_event = context.Event()
+        result_queue = context.Queue()
+        batch = Blockchain.nonce_batch
+        processes = [context.Process(target=Blockchain.search_worker,
+                                     args=(midstate, worker * batch,
+                                           workers * batch, found_event,
+                                           result_queue))
+                     for worker in range(workers)]
+        for process in processes:
+            process.start()
+
+        nonce = result_queue.get()
+        # Los demás procesos terminan al acabar su lote actual.
+        found_event.set()
+        for process in processes:
+            process.join()
+        return nonce
 
     @staticmethod
     def proof_of_work(block):
@@ -68,25 +312,47 @@ class Blockchain:
         Función que intenta distintos valores de nonce hasta obtener
         un hash que satisfaga nuestro criterio de dificultad.
         """
-        block.nonce = 0
- 
-        computed_hash = block.compute_hash()
-        while not computed_hash.startswith('0' * Blockchain.difficulty):
-            block.nonce += 1
-            computed_hash = block.compute_hash()
+        # Estado de SHA-256 tras el prefijo constante del bloque: en cada
+        # intento solo se procesan los dígitos del nonce.
+        midstate = sha256(block.hash_prefix())
+
+        # Los procesos daemon no pueden crear procesos hijos; sin `fork`
+        # se mina en un único proceso.
+        if Blockchain.pow_workers > 1 and Blockchain.can_fork and \
+                not multiprocessing.current_process().daemon:
+            nonce = Blockchain.parallel_search(midstate,
+                                               Blockchain.pow_workers)
+        else:
+            start = 0
+            nonce = Blockchain.search_nonce(midstate, start,
+                                            Blockchain.nonce_batch)
+            while nonce is None:
+                start += Blockchain.nonce_batch
+                nonce = Blockchain.search_nonce(midstate, start,
+                                                Blockchain.nonce_batch)
  
-        return computed_hash
+        block.nonce = nonce
+        block._invalidate()
+        return block.compute_hash()
 
     def add_block(self, block, proof):
         """
         Una función que agrega el bloque a la cadena luego de la verificación.
         La verificación incluye:
         * Comprobar que la prueba es válida.
+        * El índice del bloque sigue al del último bloque de la cadena.
         * El valor del hash previo del bloque coincide con el hash del último
           bloque de la cadena.
         """
-        previous_hash = self.last_block.hash
+        if not block.has_valid_fields():
+            return False
+
+        last_block = self.last_block
+        previous_hash = last_block.hash
         
+        if block.index != last_block.index + 1:
+            return False
+
         if previous_hash != block.previous_hash:
             return False
         
@@ -94,72 +360,207 @@ class Blockchain:
             return False
         
         block.hash = proof
-        self.chain.append(block)
-        
+        self.append_block(block)
+        if self.log is not None:
+            # Solo se escribe el bloque nuevo, al final del registro, en
+            # lugar de volver a guardar toda la cadena.
+            self.log.write(orjson.dumps(block.to_dict()) + b'\n')
+            self.log.flush()
+        return True
+
+    @classmethod
+    def check_chain_validity(cls, chain):
+        """
+        Comprueba que cada bloque de `chain`, una lista de objetos `Block`,
+        enlaza con el anterior y que su hash se corresponde con su
+        serialización canónica y cumple la dificultad. No modifica ni
+        guarda nada en los bloques.
+        """
+        # El bloque génesis no se mina, así que su contenido solo se puede
+        # comprobar comparándolo con el que crea cada nodo.
+        if not chain or chain[0].hash != GENESIS_HASH:
+            return False
+
+        previous_hash = "0"
+
+        for position, block in enumerate(chain):
+            block_hash = block.hash
+            if not block.has_valid_fields() or block.index != position or \
+                    previous_hash != block.previous_hash or \
+                    not isinstance(block_hash, str):
+                return False
+            if sha256(block.canonical_bytes()).hexdigest() != block_hash:
+                return False
+            # El bloque génesis no se mina, así que no tiene por qué
+            # cumplir la dificultad.
+            if position != 0 and int(block_hash, 16) >= cls.target:
+                return False
+
+            previous_hash = block_hash
+
+        return True
+
     @classmethod
     def is_valid_proof(self, block, block_hash):
         """
         Conmprobar si block_hash es un hash válido y satisface nuestro
         criterio de dificultad.
         """
-        return (block_hash.startswith('0' * Blockchain.difficulty) and
-                block_hash == block.compute_hash())
+        if isinstance(block_hash, bytes):
+            block_hash = block_hash.hex()
+        return (block_hash == block.compute_hash() and
+                int(block_hash, 16) < Blockchain.target)
+
+    @staticmethod
+    def transaction_hash(transaction):
+        """
+        Identificador corto de una transacción, usado para anunciar los
+        bloques sin repetir el contenido de las transacciones.
+        """
+        return sha256(orjson.dumps(
+            transaction, option=orjson.OPT_SORT_KEYS)).hexdigest()[:16]
 
     def add_new_transaction(self, transaction):
-        self.unconfirmed_transactions.append(transaction)
+        tx_hash = self.transaction_hash(transaction)
+        self.unconfirmed_transactions[tx_hash] = transaction
+        return tx_hash
+
+    def find_transaction(self, tx_hash, index=None):
+        """
+        Busca una transacción por su hash entre las pendientes y, si se
+        indica, en el bloque de la cadena con ese índice.
+        """
+        transaction = self.unconfirmed_transactions.get(tx_hash)
+        if transaction is None and index is not None and \
+                0 <= index < len(self):
+            for confirmed in self.transactions[index]:
+                if self.transaction_hash(confirmed) == tx_hash:
+                    return confirmed
+        return transaction
  
-    def mine(self):
+    def next_block(self):
         """
-        Esta función sirve como una interfaz para añadir las transacciones
-        pendientes al blockchain añadiéndolas al bloque y calculando la
-        prueba de trabajo.
+        Crea el siguiente bloque de la cadena, todavía sin minar, con las
+        transacciones pendientes. Retorna None si no hay ninguna.
         """
         if not self.unconfirmed_transactions:
-            return False
-            
+            return None
+
         last_block = self.last_block
-        new_block = Block(index=last_block.index + 1,
-                      transactions=self.unconfirmed_transactions,
-                      timestamp=time.time(),
-                      previous_hash=last_block.hash)
-        proof = self.proof_of_work(new_block)
-        self.add_block(new_block, proof)
-    
-        self.unconfirmed_transactions = []
+        return Block(index=last_block.index + 1,
+                     transactions=list(self.unconfirmed_transactions.values()),
+                     timestamp=time.time(),
+                     previous_hash=last_block.hash)
+
+    @staticmethod
+    def mine_block(block):
+        """
+        Calcula la prueba de trabajo del bloque y lo retorna ya minado.
+        No usa el estado del nodo, así que puede ejecutarse en otro proceso.
+        """
+        block.hash = Blockchain.proof_of_work(block)
+        return block
+
+    def add_mined_block(self, block):
+        """
+        Añade a la cadena un bloque minado por este nodo y retira sus
+        transacciones de las pendientes. Retorna False si la cadena ha
+        cambiado mientras se minaba.
+        """
+        if not self.add_block(block, block.hash):
+            return False
+        for transaction in block.transactions:
+            self.unconfirmed_transactions.pop(
+                self.transaction_hash(transaction), None)
         return True
 
-    @classmethod
-    def check_chain_validity(cls, chain):
-        result = True
-        previous_hash = "0"
+# Hash del bloque génesis, que es el mismo en todos los nodos.
+GENESIS_HASH = Blockchain().hashes[0]
 
-        for block in chain:
-            block_hash = block.hash
-            # remove the hash field to recompute the hash again
-            # using `compute_hash` method.
-            delattr(block, "hash")
+class PeerSet:
+    """
+    Conjunto de direcciones de los compañeros que guarda su serialización
+    JSON, ya que se envía en cada respuesta de `/chain` y cambia muy poco.
+    """
+    def __init__(self):
+        self.addresses = set()
+        self.cached_json = None
+
+    def add(self, address):
+        if address not in self.addresses:
+            self.addresses.add(address)
+            self.cached_json = None
+
+    def update(self, addresses):
+        for address in addresses:
+            self.add(address)
 
-            if not cls.is_valid_proof(block, block_hash) or \
-                    previous_hash != block.previous_hash:
-                result = False
-                break
+    def json(self):
+        """
+        Retorna la lista de compañeros serializada, calculándola solo si
+        ha cambiado desde la última vez.
+        """
+        if self.cached_json is None:
+            self.cached_json = orjson.dumps(sorted(self.addresses))
+        return self.cached_json
+
+    def __contains__(self, address):
+        return address in self.addresses
 
-            block.hash, previous_hash = block_hash, block_hash
+    def __iter__(self):
+        return iter(self.addresses)
 
-        return result
+    def __len__(self):
+        return len(self.addresses)
 
-# Inicializar la aplicación Flask
-app =  Flask(__name__)
+# Inicializar la aplicación Quart. Su API es la de Flask, pero los puntos
+# de acceso son asíncronos: minar o hablar con los compañeros no bloquea
+# al resto de peticiones.
+app =  Quart(__name__)
  
 # Inicializar el objeto blockchain.
 blockchain = None
-peers = set()
+peers = PeerSet()
+
+# Cliente HTTP compartido para comunicarse con los compañeros: mantiene las
+# conexiones abiertas entre peticiones en lugar de abrir una nueva cada vez.
+# Se crea al arrancar el servidor, dentro de su bucle de eventos.
+client = None
+# Tiempo máximo de espera (segundos) en las peticiones a compañeros.
+PEER_TIMEOUT = 5
+
+# Ejecutor en el que se calcula la prueba de trabajo, para que el bucle
+# de eventos siga atendiendo peticiones mientras se mina.
+pow_pool = None
 
 chain_file_name = os.environ.get('DATA_FILE')
 
+@app.before_serving
+async def start_node():
+    global client, pow_pool
+    client = httpx.AsyncClient(
+        timeout=PEER_TIMEOUT,
+        limits=httpx.Limits(max_connections=64,
+                            max_keepalive_connections=64))
+    if Blockchain.can_fork and not multiprocessing.current_process().daemon:
+        # Con 'fork' el proceso de minado hereda el estado ya cargado y no
+        # vuelve a importar este módulo (lo que repetiría la carga de
+        # DATA_FILE, la apertura del log y los manejadores de señales).
+        pow_pool = ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context('fork'))
+    else:
+        # Sin 'fork', o en procesos daemon como los workers de Hypercorn
+        # (que no pueden crear hijos), se mina en un hilo aparte.
+        pow_pool = ThreadPoolExecutor(max_workers=1)
+
+@app.after_serving
+async def stop_node():
+    await client.aclose()
+    pow_pool.shutdown()
+
 @app.route('/new_transaction', methods=['POST'])
-def new_transaction():
-    tx_data = request.get_json()
+async def new_transaction():
+    tx_data = await request.get_json()
     required_fields = ["author", "content"]
  
     for field in required_fields:
@@ -169,59 +570,115 @@ def new_transaction():
     tx_data["timestamp"] = time.time()
  
     blockchain.add_new_transaction(tx_data)
+    # Los compañeros reciben la transacción ya con su timestamp, de modo
+    # que calculan el mismo hash y pueden reconstruir los bloques que la
+    # incluyan sin tener que pedirla.
+    await relay_transaction(tx_data)
  
     return "Success", 201
 
+# Punto de acceso para recibir transacciones reenviadas por otros nodos.
+@app.route('/add_transaction', methods=['POST'])
+async def add_relayed_transaction():
+    tx_data = await request.get_json()
+    required_fields = ["author", "content"]
+
+    for field in required_fields:
+        if not tx_data.get(field):
+            return "Invalid transaction data", 400
+    if type(tx_data.get("timestamp")) is not float:
+        return "Invalid transaction data", 400
+
+    blockchain.add_new_transaction(tx_data)
+
+    return "Success", 201
+
+async def relay_transaction(tx_data):
+    """
+    Reenvía una transacción nueva a todos los compañeros de la red.
+    """
+    data = orjson.dumps(tx_data)
+    headers = {'Content-Type': "application/json"}
+    await asyncio.gather(*[client.post("{}add_transaction".format(peer),
+                                       content=data, headers=headers)
+                           for peer in list(peers)],
+                         return_exceptions=True)
+
 @app.route('/chain', methods=['GET'])
-def get_chain():
-    chain_data = []
-    for block in blockchain.chain:
-        chain_data.append(block.__dict__)
-    return json.dumps({"length": len(chain_data),
-                       "chain": chain_data,
-                       "peers": list(peers)})
+async def get_chain():
+    # Con el parámetro `since` solo se envían los bloques con índice
+    # mayor que él, para que los clientes puedan actualizarse sin
+    # descargar de nuevo toda la cadena.
+    since = request.args.get('since', default=-1, type=int)
+    return Response(chain_chunks(since), mimetype='application/json')
+
+def chain_chunks(since=-1):
+    """
+    Genera el JSON de la cadena por fragmentos, uno por bloque, para no
+    tener que construir en memoria la respuesta completa.
+    """
+    # Se fija la cadena y su longitud al empezar: si mientras tanto se
+    # añaden bloques o se reemplaza la cadena, la respuesta sigue siendo
+    # coherente.
+    chain = blockchain
+    length = len(chain)
+    yield b'{"length":%d,"chain":[' % length
+    separator = b''
+    for block_data in chain.iter_dicts(max(since, -1) + 1, length):
+        yield separator + orjson.dumps(block_data)
+        separator = b','
+    yield b'],"peers":' + peers.json() + b'}'
 
 @app.route('/mine', methods=['GET'])
-def mine_unconfirmed_transactions():
-    result = blockchain.mine()
-    if not result:
+async def mine_unconfirmed_transactions():
+    new_block = blockchain.next_block()
+    if new_block is None:
         return "No hay transacciones para minar"
-    else:
-        # Making sure we have the longest chain before announcing to the network
-        chain_length = len(blockchain.chain)
-        consensus()
-        if chain_length == len(blockchain.chain):
-            # announce the recently mined block to the network
-            announce_new_block(blockchain.last_block)
-        return "Se ha realizado el minado de un nuevo bloque con los mensajes pendientes"
+
+    loop = asyncio.get_running_loop()
+    new_block = await loop.run_in_executor(pow_pool, Blockchain.mine_block,
+                                           new_block)
+    if not blockchain.add_mined_block(new_block):
+        return "La cadena ha cambiado durante el minado; el bloque se ha descartado"
+
+    # Making sure we have the longest chain before announcing to the network
+    chain_length = len(blockchain)
+    await consensus()
+    if chain_length == len(blockchain):
+        # announce the recently mined block to the network
+        await announce_new_block(blockchain.last_block, request.host_url)
+    return "Se ha realizado el minado de un nuevo bloque con los mensajes pendientes"
 
 @app.route('/pending_tx')
-def get_pending_tx():
-    return json.dumps(blockchain.unconfirmed_transactions)
+async def get_pending_tx():
+    pending = list(blockchain.unconfirmed_transactions.values())
+    return Response(orjson.dumps(pending), mimetype='application/json')
 
 # Punto de acceso para añadir nuevos compañeros a la red.
 @app.route('/register_node', methods=['POST'])
-def register_new_peers():
+async def register_new_peers():
     # La dirección del nodo compañero.
-    node_address = request.get_json()["node_address"]
+    node_address = (await request.get_json())["node_address"]
     if not node_address:
         return "Invalid data", 400
 
     # Añadir el nodo a la lista de compañeros.
-    peers.add(node_address)
+    if node_address not in peers:
+        peers.add(node_address)
+        log_peers([node_address])
 
     # Retornar el blockhain al nuevo nodo registrado para que pueda sincronizar.
-    return get_chain()
+    return await get_chain()
 
 @app.route('/register_with', methods=['POST'])
-def register_with_existing_node():
+async def register_with_existing_node():
     """
     Internamente llama al punto de acceso `/register_node`
     para registrar el nodo actual con el nodo remoto especificado
     en la petición, y sincronizar el blockchain asimismo con el
     nodo remoto. 
     """
-    node_address = request.get_json()["node_address"]
+    node_address = (await request.get_json())["node_address"]
     if not node_address:
         return "Invalid data", 400
 
@@ -230,44 +687,102 @@ def register_with_existing_node():
 
     # Hacer una petición para registrarse en el nodo remoto y obtener
     # información.
-    response = requests.post(node_address + "/register_node",
-                             data=json.dumps(data), headers=headers)
+    response = await client.post(node_address + "/register_node",
+                                 content=orjson.dumps(data), headers=headers)
 
     if response.status_code == 200:
-        global blockchain
-        global peers
         # Actualizar la cadena y los compañeros.
-        chain_dump = response.json()['chain']
-        blockchain = create_chain_from_dump(chain_dump)
-        peers.update(response.json()['peers'])
+        response_data = orjson.loads(response.content)
+        chain_dump = response_data['chain']
+        peers.update(response_data['peers'])
+        replace_chain(create_chain_from_dump(chain_dump))
         return "Registration successful ", 200
     else:
         # si algo sale mal, pasárselo a la respuesta de la API
         return response.content, response.status_code
 
+# Punto de acceso para que otros nodos obtengan transacciones por su hash.
+@app.route('/get_tx', methods=['GET'])
+async def get_transactions():
+    index = request.args.get('index', type=int)
+    transactions = {}
+    for tx_hash in request.args.getlist('hash'):
+        transaction = blockchain.find_transaction(tx_hash, index)
+        if transaction is not None:
+            transactions[tx_hash] = transaction
+    return Response(orjson.dumps(transactions), mimetype='application/json')
+
 # punto de acceso para añadir un bloque minado por alguien más a la cadena del nodo.
 @app.route('/add_block', methods=['POST'])
-def verify_and_add_block():
-    block_data = request.get_json()
+async def verify_and_add_block():
+    block_data = await request.get_json()
+    if "transactions" in block_data:
+        transactions = block_data["transactions"]
+    else:
+        # El bloque se anuncia solo con los hashes de sus transacciones:
+        # se toman de las pendientes y se piden al nodo de origen las que
+        # falten.
+        transactions = await fetch_block_transactions(block_data)
+        if transactions is None:
+            return "El bloque ha sido descartado por el nodo: " \
+                   "faltan transacciones", 400
+
     block = Block(block_data["index"],
-                  block_data["transactions"],
+                  transactions,
                   block_data["timestamp"],
                   block_data["previous_hash"],
                   block_data["nonce"])
  
     proof = block_data['hash']
     try:
-        blockchain.add_block(block, proof)
+        added = blockchain.add_block(block, proof)
     except ValueError as e:
-        return "El bloque ha sido descartado por el nodo: " + e.str(), 400
+        return "El bloque ha sido descartado por el nodo: " + str(e), 400
+    if not added:
+        return "El bloque ha sido descartado por el nodo", 400
+
+    # Las transacciones incluidas en el bloque ya no están pendientes.
+    for tx_hash in block_data.get("tx_hashes", []):
+        blockchain.unconfirmed_transactions.pop(tx_hash, None)
  
     return "Block added to the chain", 201
 
-def create_chain_from_dump(chain_dump):
+async def fetch_block_transactions(block_data):
+    """
+    Reconstruye la lista de transacciones de un bloque anunciado por
+    hashes. Retorna None si alguna no se ha podido obtener.
+    Las que falten solo se piden al nodo de origen si es un compañero
+    registrado, para no hacer peticiones a direcciones arbitrarias.
+    """
+    tx_hashes = block_data["tx_hashes"]
+    found = {tx_hash: blockchain.unconfirmed_transactions[tx_hash]
+             for tx_hash in tx_hashes
+             if tx_hash in blockchain.unconfirmed_transactions}
+    missing = [tx_hash for tx_hash in tx_hashes if tx_hash not in found]
+
+    if missing:
+        origin = block_data.get("origin")
+        if not isinstance(origin, str) or origin not in peers:
+            return None
+        try:
+            response = await client.get(
+                '{}get_tx'.format(origin),
+                params={'index': block_data["index"], 'hash': missing})
+        except httpx.HTTPError:
+            return None
+        if response.status_code != 200:
+            return None
+        found.update(orjson.loads(response.content))
+
+    if any(tx_hash not in found for tx_hash in tx_hashes):
+        return None
+    return [found[tx_hash] for tx_hash in tx_hashes]
+
+def create_chain_from_dump(chain_dump, has_genesis=True):
     generated_blockchain = Blockchain()
-    for idx, block_data in enumerate(chain_dump):
-        if idx == 0:
-            continue  # skip genesis block
+    if has_genesis:
+        chain_dump = chain_dump[1:]  # skip genesis block
+    for block_data in chain_dump:
         block = Block(block_data["index"],
                       block_data["transactions"],
                       block_data["timestamp"],
@@ -277,42 +792,164 @@ def create_chain_from_dump(chain_dump):
         generated_blockchain.add_block(block, proof)
     return generated_blockchain
 
-def save_chain():
-    if chain_file_name is not None:
-        with open(chain_file_name, 'w') as chain_file:
-            chain_file.write(get_chain())
+def replace_chain(new_blockchain):
+    """
+    Sustituye la cadena del nodo por otra. Como deja de ser una simple
+    ampliación de la anterior, el registro en disco se reescribe entero.
+    """
+    global blockchain
+    log = blockchain.log
+    blockchain = new_blockchain
+    if log is not None:
+        # Se escribe en un fichero aparte que luego sustituye al registro,
+        # para que una caída a mitad de escritura no pierda la cadena.
+        tmp_name = chain_file_name + '.tmp'
+        with open(tmp_name, 'wb') as tmp_file:
+            # El bloque génesis no se guarda: se vuelve a crear al arrancar.
+            for block_data in blockchain.iter_dicts(1):
+                tmp_file.write(orjson.dumps(block_data) + b'\n')
+            for address in peers:
+                tmp_file.write(orjson.dumps({"peer": address}) + b'\n')
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        log.close()
+        os.replace(tmp_name, chain_file_name)
+        blockchain.log = open(chain_file_name, 'ab')
+
+def log_peers(addresses):
+    """
+    Añade al registro en disco las direcciones de nuevos compañeros.
+    """
+    if blockchain.log is not None:
+        for address in addresses:
+            blockchain.log.write(orjson.dumps({"peer": address}) + b'\n')
+        blockchain.log.flush()
+
+def load_chain_log(file_name):
+    """
+    Reconstruye la cadena y los compañeros a partir del registro en disco,
+    que contiene una línea JSON por bloque o por compañero. También admite
+    una instantánea completa de la cadena como la que retorna `/chain`.
+    Retorna la cadena y si hace falta reescribir el registro.
+
+    Si algún bloque del registro no es válido (por ejemplo, porque se
+    guardó con otro formato de hash) el fichero original se aparta a
+    `<fichero>.old` en lugar de sobrescribirse con una cadena más corta.
+    """
+    chain_dump = []
+    rewrite = False
+    if os.path.exists(file_name):
+        with open(file_name, 'rb') as chain_file:
+            for line in chain_file:
+                if not line.strip():
+                    continue
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # Una última línea a medio escribir si el nodo se cayó.
+                    rewrite = True
+                    break
+                if "chain" in record:
+                    # La instantánea incluye el bloque génesis; el
+                    # registro, no.
+                    chain_dump = list(record["chain"][1:])
+                    peers.update(record["peers"])
+                    rewrite = True
+                elif "peer" in record:
+                    peers.add(record["peer"])
+                else:
+                    chain_dump.append(record)
+    chain = create_chain_from_dump(chain_dump, has_genesis=False)
+    stored_blocks = len(chain_dump)
+    if len(chain) - 1 < stored_blocks:
+        backup_name = file_name + '.old'
+        os.replace(file_name, backup_name)
+        print("Solo {} de {} bloques de {} son válidos; el registro original "
+              "se ha movido a {}".format(len(chain) - 1, stored_blocks,
+                                         file_name, backup_name),
+              file=sys.stderr)
+        rewrite = True
+    return chain, rewrite
+
+def close_chain_log():
+    # Los bloques ya se han ido guardando a medida que se añadían, así que
+    # al salir basta con cerrar el registro.
+    if blockchain is not None and blockchain.log is not None:
+        blockchain.log.close()
 
 def exit_from_signal(signum, stack_frame):
     sys.exit(0)
 
-def announce_new_block(block):
-    for peer in peers:
-        url = "{}add_block".format(peer)
-        headers = {'Content-Type': "application/json"}
-        requests.post(url,
-                      data=json.dumps(block.__dict__, sort_keys=True),
-                      headers=headers)
+async def announce_new_block(block, origin):
+    """
+    Envía el bloque recién minado a todos los compañeros de la red, a la
+    vez y reutilizando las conexiones abiertas del cliente.
+    En lugar de las transacciones se envían sus hashes; los compañeros
+    piden a `origin` las que no tengan.
+    """
+    block_data = block.to_dict()
+    transactions = block_data.pop("transactions")
+    block_data["tx_hashes"] = [Blockchain.transaction_hash(transaction)
+                               for transaction in transactions]
+    block_data["origin"] = origin
+    data = orjson.dumps(block_data, option=orjson.OPT_SORT_KEYS)
+    headers = {'Content-Type': "application/json"}
+
+    # Un compañero caído no debe impedir avisar al resto, así que sus
+    # errores se recogen en lugar de propagarse.
+    await asyncio.gather(*[client.post("{}add_block".format(peer),
+                                       content=data, headers=headers)
+                           for peer in list(peers)],
+                         return_exceptions=True)
+
+async def fetch_peer_chain(node):
+    """
+    Obtiene la cadena de un compañero, o None si no responde.
+    """
+    try:
+        response = await client.get('{}chain'.format(node))
+    except httpx.HTTPError:
+        return None
+    if response.status_code != 200:
+        return None
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        return None
 
-def consensus():
+async def consensus():
     """
     Nuestro simple algoritmo de consenso. Si una cadena válida más larga es
     encontrada, la nuestra es reemplazada por ella.
     """
-    global blockchain
- 
     longest_chain = None
-    current_len = len(blockchain.chain)
+    current_len = len(blockchain)
  
-    for node in peers:
-        response = requests.get('{}chain'.format(node))
-        length = response.json()['length']
-        chain = response.json()['chain']
-        if length > current_len and blockchain.check_chain_validity(chain):
+    # Las cadenas de todos los compañeros se piden a la vez.
+    responses = await asyncio.gather(*[fetch_peer_chain(node)
+                                       for node in list(peers)])
+
+    for response_data in responses:
+        # La respuesta viene de otro nodo: cualquier campo que falte o no
+        # tenga el tipo esperado descarta su cadena.
+        if not isinstance(response_data, dict):
+            continue
+        length = response_data.get('length')
+        chain_data = response_data.get('chain')
+        if type(length) is not int or not isinstance(chain_data, list) or \
+                length <= current_len:
+            continue
+        try:
+            chain = [Block.from_dict(block_data)
+                     for block_data in chain_data]
+        except (KeyError, TypeError):
+            continue
+        if len(chain) == length and Blockchain.check_chain_validity(chain):
             current_len = length
-            longest_chain = chain
+            longest_chain = Blockchain(chain)
  
     if longest_chain:
-        blockchain = longest_chain
+        replace_chain(longest_chain)
         return True
  
     return False
@@ -320,23 +957,15 @@ def consensus():
 # Uncomment this line if you want to specify the port number in the code
 #app.run(debug=True, port=8000)
 
-atexit.register(save_chain)
+atexit.register(close_chain_log)
 signal.signal(signal.SIGTERM, exit_from_signal)
 signal.signal(signal.SIGINT, exit_from_signal)
 
 if chain_file_name is None:
-    data = None
-else:
-    with open(chain_file_name, 'r') as chain_file:
-        raw_data = chain_file.read()
-        if raw_data is None or len(raw_data) == 0:
-            data = None
-        else:
-            data = json.loads(raw_data)
-
-if data is None:
     # the node's copy of blockchain
     blockchain = Blockchain()
 else:
-    blockchain = create_chain_from_dump(data['chain'])
-    peers.update(data['peers'])
\ No newline at end of file
+    blockchain, rewrite_log = load_chain_log(chain_file_name)
+    blockchain.log = open(chain_file_name, 'ab')
+    if rewrite_log:
+        replace_chain(blockchain)